@@ -4,7 +4,7 @@
 Advanced Relevance Feedback with TF-IDF-based Query Expansion
 
 Usage:
-    python run.py <google_api_key> <google_engine_id> <target_precision> "<query>"
+    python run.py [--full-text] <google_api_key> <google_engine_id> <target_precision> "<query>"
 
 Example:
     python run.py ABC123XYZ abc456def 0.9 "milky way"
@@ -14,89 +14,200 @@ Date:   2025-02-23
 
 Notes:
  - Demonstrates a basic TF-IDF approach to pick expansion terms.
- - Shows a small-scale permutation strategy for query reordering if query <= 5 terms.
+ - Shows a small-scale permutation strategy for reordering up to 4 new terms.
  - Ignores non-HTML results in both indexing and precision calculation.
  - Exits if fewer than 10 results are returned in the first iteration, as per instructions.
- - Only uses 'title' and 'snippet' for text analysis. You can optionally fetch full HTML pages.
+ - Only uses 'title' and 'snippet' for text analysis. Pass --full-text to fetch full HTML pages instead.
 
 """
 
+import os
 import sys
+import re
+import codecs
 import pprint
 import itertools
-import math
-from googleapiclient.discovery import build
-import requests
-from bs4 import BeautifulSoup
+import functools
+import hashlib
+import shelve
+import pickle
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import numpy as np
 
-# Trying to use nltk library for tokenize and specify stopwords
-# other than manually listing stopwords
-import nltk
-nltk.download('brown')
+# Heavier libraries (nltk and its data, the Google API client, requests, selectolax,
+# scikit-learn) are imported on first use, so the script starts fast and argument
+# errors are reported right away.
 
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.corpus import brown
-from nltk import bigrams, FreqDist
+# A token is a run of (lowercase) letters, like the alphabetic tokens kept before;
+# for non-ASCII text any Unicode letter counts (no digits or underscores)
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+")
 
+# Byte translation table for ASCII text: keeps lowercase letters, lowercases uppercase
+# letters and turns everything else into a space, so tokens are just split() apart
+LOWER_ALPHA_TABLE = bytes(c if 97 <= c <= 122 else c + 32 if 65 <= c <= 90 else 32
+                          for c in range(256))
 
-bigram_freq = FreqDist(bigrams(brown.words()))
+# Simple set of (lowercase) file extensions that we consider "non-HTML."
+NON_HTML_EXTENSIONS = frozenset({".pdf", ".doc",
+                                 ".docx", ".ppt", ".pptx", ".xls", ".xlsx"})
 
-# ensure nltk data are correctly downloaded
-try:
-    stop_words = set(stopwords.words('english'))
-except LookupError:
-    nltk.download('stopwords')
-    stop_words = set(stopwords.words('english'))
+# Optional on-disk cache of Custom Search responses, so repeated runs of the same
+# query skip the API call (disabled unless HRF_IR_SEARCH_CACHE names a cache file)
+SEARCH_CACHE_PATH = os.environ.get("HRF_IR_SEARCH_CACHE")
 
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
+# Largest number of bytes of a webpage downloaded and parsed for its full text
+MAX_PAGE_BYTES = 200_000
 
-try:
-    nltk.data.find('tokenizers/punkt_tab')
-except LookupError:
-    nltk.download('punkt_tab')
+# Content types of the pages whose full text is extracted
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
 
-# Simple set of file extensions that we consider "non-HTML."
-NON_HTML_EXTENSIONS = {".pdf", ".doc",
-                       ".docx", ".ppt", ".pptx", ".xls", ".xlsx"}
+# Elements dropped from a fetched page before extracting its text: scripts, styles
+# and the navigation chrome around the content, whose words only add noise to TF-IDF
+# (not <form> or <aside>: some sites wrap the whole page in a form, and asides often
+# hold relevant text such as infoboxes)
+NON_CONTENT_TAGS = ["script", "style", "noscript", "nav", "footer"]
+
+# Where the Brown corpus bigram frequencies are cached between runs
+BIGRAM_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "hrf_ir", "brown_bigrams.pkl")
+
+# Full text of the webpages fetched so far, by link. Unlike the snippet, the text
+# of a page does not depend on the query, so it is reused across iterations.
+full_text_cache = {}
+
+# Largest number of new terms reordered by trying all their orderings (4! = 24)
+MAX_REORDER_TERMS = 4
+
+# Number of webpages fetched at the same time when using the full text
+MAX_FETCH_WORKERS = 10
+
+
+@functools.lru_cache(maxsize=None)
+def load_stop_words():
+    """
+    Trying to use nltk library to specify stopwords
+    other than manually listing stopwords.
+    Loaded (and downloaded if needed) once, on first use.
+    """
+    import nltk
+    from nltk.corpus import stopwords
+
+    # ensure nltk data are correctly downloaded
+    try:
+        return frozenset(stopwords.words('english'))
+    except LookupError:
+        nltk.download('stopwords')
+        return frozenset(stopwords.words('english'))
+
+
+@functools.lru_cache(maxsize=None)
+def load_bigram_freq():
+    """
+    Bigram frequency distribution of the Brown corpus, loaded once, on first use.
+    Counting the ~1M Brown bigrams takes seconds, so the counts are pickled to
+    BIGRAM_CACHE_PATH (as a plain Counter, missing bigrams count 0) and later runs
+    just load them.
+    """
+    try:
+        with open(BIGRAM_CACHE_PATH, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    import nltk
+    from nltk.corpus import brown
+    from nltk import bigrams
+
+    # ensure nltk data are correctly downloaded
+    try:
+        nltk.data.find('corpora/brown')
+    except LookupError:
+        nltk.download('brown')
+
+    bigram_freq = Counter(bigrams(brown.words()))
+
+    # Best effort: without a writable cache directory, just rebuild next time
+    try:
+        os.makedirs(os.path.dirname(BIGRAM_CACHE_PATH), exist_ok=True)
+        tmp_path = BIGRAM_CACHE_PATH + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(bigram_freq, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, BIGRAM_CACHE_PATH)
+    except OSError:
+        pass
+    return bigram_freq
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session():
+    """
+    Shared HTTP session, so full-text fetches reuse pooled keep-alive connections
+    (one pooled connection per fetch worker) instead of a new TCP/TLS handshake per page.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    http_session = requests.Session()
+    http_session.headers.update({"User-Agent": "HRF-IR/1.0"})
+    http_adapter = HTTPAdapter(pool_connections=MAX_FETCH_WORKERS,
+                               pool_maxsize=MAX_FETCH_WORKERS, max_retries=1)
+    http_session.mount("http://", http_adapter)
+    http_session.mount("https://", http_adapter)
+    return http_session
 
 
 def parse_args():
-    if len(sys.argv) != 5:
-        print("Usage: python advanced_proj1.py <google_api_key> <google_engine_id> <target_precision> \"<query>\"")
+    args = sys.argv[1:]
+    # Optional flag: build the index from the full webpages instead of title+snippet
+    use_full_text = "--full-text" in args
+    if use_full_text:
+        args.remove("--full-text")
+
+    if len(args) != 4:
+        print("Usage: python advanced_proj1.py [--full-text] <google_api_key> <google_engine_id> <target_precision> \"<query>\"")
         sys.exit(1)
 
-    google_api_key = sys.argv[1]
-    google_engine_id = sys.argv[2]
+    google_api_key = args[0]
+    google_engine_id = args[1]
     try:
-        target_precision = float(sys.argv[3])
+        target_precision = float(args[2])
     except ValueError:
         print("Error: target_precision must be a float (e.g., 0.9).")
         sys.exit(1)
-    initial_query = sys.argv[4].strip("\"")
+    initial_query = args[3].strip("\"")
 
-    return google_api_key, google_engine_id, target_precision, initial_query
+    return google_api_key, google_engine_id, target_precision, initial_query, use_full_text
 
 
 def build_service(google_api_key):
     """
     Build the Google API service object for Custom Search.
+    All its requests go through one httplib2.Http, which keeps the connection to the
+    API alive between iterations.
     """
-    return build("customsearch", "v1", developerKey=google_api_key)
+    import httplib2
+    from googleapiclient.discovery import build
+
+    http = httplib2.Http(timeout=10)
+    return build("customsearch", "v1", developerKey=google_api_key,
+                 http=http, cache_discovery=False)
 
 
 def is_likely_html(url):
     """
-    A crude way to detect if a URL is likely an HTML page by checking its file extension.
+    A crude way to detect if a URL is likely an HTML page by checking its file extension
+    (the extension of the URL path, ignoring any query string or fragment).
     """
-    url = url.lower()
-    for ext in NON_HTML_EXTENSIONS:
-        if url.endswith(ext):
-            return False
-    return True
+    try:
+        path = urlsplit(url).path
+    except ValueError:
+        # Malformed URL (e.g. an unclosed IPv6 bracket), treat it as HTML like before
+        return True
+    dot = path.rfind(".")
+    extension = path[dot:].lower() if dot != -1 else ""
+    return extension not in NON_HTML_EXTENSIONS
 
 
 def fetch_full_text(url):
@@ -104,42 +215,100 @@ def fetch_full_text(url):
     Fetch the full text from a URL by downloading and parsing the HTML.
     Returns the extracted text or an empty string on failure.
     """
+    from selectolax.lexbor import LexborHTMLParser
+
     try:
-        response = requests.get(url, timeout=5)
-        if response.status_code != 200:
+        with get_http_session().get(url, timeout=5, stream=True) as response:
+            if response.status_code != 200:
+                return ""
+            # Skip responses that are not HTML (e.g. a PDF behind an extension-less link)
+            # before downloading their body
+            content_type = response.headers.get("content-type", "")
+            content_type = content_type.split(";")[0].strip().lower()
+            if content_type and content_type not in HTML_CONTENT_TYPES:
+                return ""
+            # Only read the beginning of the page, it holds enough text for TF-IDF
+            raw = response.raw.read(MAX_PAGE_BYTES, decode_content=True)
+            # Pages may declare a charset Python does not know, decode those as UTF-8
+            encoding = response.encoding or "utf-8"
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                encoding = "utf-8"
+            html = raw.decode(encoding, errors="ignore")
+        # Parse with the lexbor engine (native code, much faster than html.parser)
+        tree = LexborHTMLParser(html)
+        # Remove script, style and page chrome elements (in one native call)
+        tree.strip_tags(NON_CONTENT_TAGS)
+        if tree.body is None:
             return ""
-        html = response.text
-        soup = BeautifulSoup(html, 'html.parser')
-        # Remove script and style elements
-        for script_or_style in soup(["script", "style"]):
-            script_or_style.decompose()
         # Get text and join paragraphs
-        texts = soup.stripped_strings
-        full_text = " ".join(texts)
+        full_text = tree.body.text(separator=" ", strip=True)
         return full_text
     except Exception as e:
         print(f"Error fetching full text from {url}: {e}")
         return ""
 
 
+def fetch_full_texts(links):
+    """
+    Fetch the full text of several webpages concurrently (see fetch_full_text),
+    reusing the text of the pages already fetched in earlier iterations.
+    Returns the texts in the same order as links.
+    """
+    texts = {link: full_text_cache[link] for link in links if link in full_text_cache}
+    missing = [link for link in dict.fromkeys(links) if link not in texts]
+    if missing:
+        # Create the shared session up front rather than racing to do it in the workers
+        get_http_session()
+        workers = min(MAX_FETCH_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            texts.update(zip(missing, executor.map(fetch_full_text, missing)))
+        # Failed fetches (empty text) are not cached, so they are retried next time
+        full_text_cache.update((link, texts[link]) for link in missing if texts[link])
+    return [texts[link] for link in links]
+
+
+@functools.lru_cache(maxsize=256)
+def cached_search(service, engine_id, query, num_results):
+    """
+    Call the Custom Search API once per (engine_id, query, num_results) and memoize
+    the (title, link, snippet) of each item, in memory and, if SEARCH_CACHE_PATH is
+    set, on disk across runs. Errors are raised and never cached.
+    """
+    key = hashlib.sha1(
+        f"{engine_id}\0{query}\0{num_results}".encode("utf-8")).hexdigest()
+    if SEARCH_CACHE_PATH:
+        with shelve.open(SEARCH_CACHE_PATH) as cache:
+            if key in cache:
+                return cache[key]
+
+    # Partial response: only request the item fields used below
+    res = service.cse().list(
+        q=query,
+        cx=engine_id,
+        num=num_results,
+        fields="items(title,link,snippet)"
+    ).execute()
+    items = tuple((item.get("title", ""), item.get("link", ""), item.get("snippet", ""))
+                  for item in res.get("items", []))
+
+    if SEARCH_CACHE_PATH:
+        with shelve.open(SEARCH_CACHE_PATH) as cache:
+            cache[key] = items
+    return items
+
+
 def search_query(service, engine_id, query, num_results=10):
     """
     Execute the query via the Custom Search API, return up to num_results = 10 documents.
     Each doc is a tuple: (title, link, snippet, is_html).
     """
     try:
-        res = service.cse().list(
-            q=query,
-            cx=engine_id,
-            num=num_results
-        ).execute()
+        items = cached_search(service, engine_id, query, num_results)
 
-        items = res.get("items", [])
         results = []
-        for item in items:
-            title = item.get("title", "")
-            link = item.get("link", "")
-            snippet = item.get("snippet", "")
+        for title, link, snippet in items:
             # Check if the doc is HTML or not
             html_flag = is_likely_html(link)
             results.append((title, link, snippet, html_flag))
@@ -164,11 +333,16 @@ def display_results(results):
     print("===========================================================")
 
 
-def get_relevance_feedback(results):
+def get_relevance_feedback(results, known_relevance=None):
     """
     Interactively ask user for relevance (y/n).
+    Results whose URL is in known_relevance ({url: relevant}, judged in an earlier
+    iteration) are not asked again, their previous answer is reused.
     Return a list of booleans (True if relevant, False otherwise).
     """
+    if known_relevance is None:
+        known_relevance = {}
+
     relevance = []
     print("\n==================== RELEVANCE FEEDBACK ====================")
     for i, (title, link, snippet, is_html) in enumerate(results, start=1):
@@ -176,6 +350,11 @@ def get_relevance_feedback(results):
         print(f"Title: {title}")
         print(f"URL:   {link}")
         print(f"Summary: {snippet}")
+        if link in known_relevance:
+            relevant = known_relevance[link]
+            print(f"Relevant (y/n)? {'y' if relevant else 'n'} (already judged)")
+            relevance.append(relevant)
+            continue
         user_input = input("Relevant (y/n)? ").strip().lower()
         while user_input not in ["y", "n"]:
             user_input = input("Please enter 'y' or 'n': ").strip().lower()
@@ -190,189 +369,216 @@ def compute_precision(results, relevance):
     If 10 documents were returned but only 8 are HTML, we compute
     (# relevant_html) / (number_of_html_docs).
     """
-    html_docs = [(res, rel)
-                 for (res, rel) in zip(results, relevance) if res[3] is True]
-    if not html_docs:
+    # Count the HTML docs, and how many of them are relevant, in a single pass
+    num_html = 0
+    relevant_html = 0
+    for (_, _, _, is_html), rel in zip(results, relevance):
+        if is_html:
+            num_html += 1
+            relevant_html += rel
+    if num_html == 0:
         return 0.0  # No HTML docs => precision = 0
 
-    # Count how many are relevant among the HTML docs
-    relevant_html = sum(rel for (_, rel) in html_docs)
-    return relevant_html / len(html_docs)
+    return relevant_html / num_html
 
 
+@functools.lru_cache(maxsize=4096)
 def tokenize(text):
     """
-    Now use nltk library for tokenization
+    Split the lowercased text into alphabetic tokens, dropping nltk stopwords.
+    ASCII text (the common case) is lowercased and split in a single translate pass,
+    other text goes through the regex.
+    Returns a tuple, memoized per text since the same titles and snippets come back
+    across iterations.
     """
-    tokens = word_tokenize(text.lower())
-    tokens = [t for t in tokens if t.isalpha() and t not in stop_words]
-    return tokens
-
-
-def build_tfidf_index(results, use_full_text=False):
+    stop_words = load_stop_words()
+    if text.isascii():
+        words = text.encode("ascii").translate(LOWER_ALPHA_TABLE).decode("ascii").split()
+    else:
+        words = TOKEN_PATTERN.findall(text.lower())
+    # Tokens are interned: a term repeated across documents is one shared string,
+    # so vocabulary lookups on it compare by identity
+    # (filtering in a list comprehension, with locals bound, beats a generator)
+    intern = sys.intern
+    return tuple([intern(t) for t in words if t not in stop_words])
+
+
+def build_tfidf_index(results, use_full_text=False, full_texts=None):
     """
     Build a small TF-IDF index for the top-10 documents (title+snippet).
     Return:
-      - docs_tokens: a list of dictionaries [ {term: tf_in_doc}, ... ] 
-                     for each document in order
-      - df: a dictionary {term: number_of_docs_that_have_it}
+      - tfidf: a sparse matrix (one row per indexed document that has any term, one column per term)
+               holding the normalized TF-IDF weight of each term in each document
+      - terms: the vocabulary, terms[j] is the term of column j (sorted)
+      - doc_ids: doc_ids[i] is the position in results of the document in row i
+      - first_rank: a sparse matrix shaped like tfidf, the rank (from 1) of each term
+                    among the distinct terms of its document in order of first appearance
+    With use_full_text, full_texts may hold the already fetched text of every HTML
+    result (in order), otherwise the pages are fetched here.
     By the project hint, we only consider documents that are likely HTML, so we skip non-HTML docs here.
     """
-    df = {}
-    docs_tokens = []
-
-    # Process each search result
-    for (title, link, snippet, is_html) in results:
-        if not is_html:
-            # Skip non-HTML documents by appending an empty dictionary
-            docs_tokens.append({})
-            continue
-
-        if use_full_text:
-            # Fetch and use the full text from the webpage
-            full_text = fetch_full_text(link)
-            # Combine title and full text for a more comprehensive text representation
-            text = title + " " + full_text
-        else:
-            # Use title and snippet as the text source
-            text = title + " " + snippet
-
-        # Tokenize the combined text using nltk
-        tokens = tokenize(text)
-        tf_map = {}
-        # Create a term frequency map for the current document
-        for t in tokens:
-            tf_map[t] = tf_map.get(t, 0) + 1
-
-        # Update the global document frequency (DF) for each unique term
-        for term in set(tokens):
-            df[term] = df.get(term, 0) + 1
-
-        # Append the term frequency map to the list of document tokens
-        docs_tokens.append(tf_map)
-
-    return docs_tokens, df
-
-
-def compute_doc_vector(tf_map, N, df):
-    """
-    Compute a normalized TF-IDF vector for a single document.
-    """
-    # Calculate the total number of terms in the document for normalization
-    total_terms = sum(tf_map.values())
-    vector = {}
-
-    # If there are no terms, return an empty vector
-    if total_terms == 0:
-        return vector
-    
-    # For each term in the document, calculate the normalized TF-IDF weight
-    for term, tf in tf_map.items():
-        if term in df and df[term] > 0:
-            normalized_tf = tf / total_terms # Normalized term frequency
-            # Multiply by the logarithmic inverse document frequency
-            vector[term] = normalized_tf * math.log(float(N) / df[term], 2)
-    return vector
-
-
-def pick_new_terms_rocchio(current_query_terms, docs_tokens, df, relevance, max_new_terms=2, alpha=1.0, beta=0.75, gamma=0.15):
+    from scipy.sparse import csr_matrix
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    # Skip non-HTML documents, they get no row in the index
+    doc_ids = [idx for idx, (_, _, _, is_html) in enumerate(results) if is_html]
+
+    if use_full_text:
+        # Fetch the full text of all webpages concurrently,
+        # unless the caller already fetched them (e.g. in the background)
+        if full_texts is None:
+            full_texts = fetch_full_texts([results[idx][1] for idx in doc_ids])
+        # Combine title and full text for a more comprehensive text representation
+        texts = [results[idx][0] + " " + full_text
+                 for idx, full_text in zip(doc_ids, full_texts)]
+    else:
+        # Use title and snippet as the text source
+        texts = [results[idx][0] + " " + results[idx][2] for idx in doc_ids]
+
+    # Count raw term frequencies for all documents at once, straight into a
+    # float32 CSR matrix (int32 column indices) that is then weighted in place
+    token_lists = [tokenize(text) for text in texts]
+    vectorizer = CountVectorizer(
+        tokenizer=tokenize, lowercase=False, token_pattern=None, dtype=np.float32)
+    try:
+        tf = vectorizer.fit_transform(texts)
+    except ValueError:
+        # No document produced any term
+        return csr_matrix((0, 0), dtype=np.float32), np.array([], dtype=object), [], csr_matrix((0, 0), dtype=np.int32)
+    terms = vectorizer.get_feature_names_out()
+    vocabulary = vectorizer.vocabulary_
+
+    # Rank (from 1) of each term among the distinct terms of its document, in order of
+    # first appearance; Rocchio uses it to break ties between equal scores in favour of
+    # the earliest (e.g. title) terms. Once each row stores its columns sorted, the
+    # ranks of that row are the argsort of its columns in appearance order.
+    tf.sort_indices()
+    ranks = np.empty(tf.nnz, dtype=np.int32)
+    for row, tokens in enumerate(token_lists):
+        cols = np.fromiter(map(vocabulary.__getitem__, dict.fromkeys(tokens)), dtype=np.int64)
+        ranks[tf.indptr[row]:tf.indptr[row + 1]] = np.argsort(cols) + 1
+    first_rank = csr_matrix((ranks, tf.indices, tf.indptr), shape=tf.shape)
+
+    # Document frequency and logarithmic inverse document frequency of each term,
+    # N counts every retrieved result like before (non-HTML docs included)
+    N = len(results)
+    # (each row of the CSR matrix lists a column index once per distinct term,
+    # so counting column indices counts documents)
+    df = np.bincount(tf.indices, minlength=tf.shape[1])
+    idf = np.log2(N / df)
+
+    # Weight every stored entry in place: divide by the total number of terms
+    # in its document and multiply by the idf of its term, looked up once per term
+    tfidf = tf  # weighted in place, no float copy of the counts
+    total_terms = tfidf.sum(axis=1).A1
+    tfidf.data *= idf[tfidf.indices] / np.repeat(total_terms, np.diff(tfidf.indptr))
+
+    # Documents without any term (e.g. a page that failed to download) take no part
+    # in Rocchio, so only the others are kept as rows
+    nonempty_rows = np.flatnonzero(np.diff(tfidf.indptr))
+    if len(nonempty_rows) < len(doc_ids):
+        tfidf = tfidf[nonempty_rows]
+        first_rank = first_rank[nonempty_rows]
+        doc_ids = [doc_ids[row] for row in nonempty_rows]
+
+    return tfidf, terms, doc_ids, first_rank
+
+
+def pick_new_terms_rocchio(current_query_terms, tfidf, terms, doc_ids, first_rank, relevance, max_new_terms=2, alpha=1.0, beta=0.75, gamma=0.15):
     """
     Use Rocchio algorithm to select new query expansion terms.
     input: alpha, beta, gamma: Rocchio parameters.
     Returns a list of new terms with the highest Rocchio scores.
     """
-    N = len(docs_tokens)
-
-    # Build the current query vector.
-    Q0 = {}
-    for term in current_query_terms:
-        term = term.lower()
-        Q0[term] = Q0.get(term, 0) + 1.0
-
-    # Accumulate document vectors for both the relevant and irrelevant documents.
-    relevant_vec = {}
-    non_relevant_vec = {}
-    num_rel = 0
-    num_non_rel = 0
+    num_terms = len(terms)
 
-    for idx, tf_map in enumerate(docs_tokens):
-        # Compute the normalized TF-IDF vector for the current document
-        doc_vector = compute_doc_vector(tf_map, N, df)
+    # Build the current query vector over the index vocabulary,
+    # with a boolean mask of the vocabulary terms already in the query.
+    query_counts = Counter(t.lower() for t in current_query_terms)
+    in_query = np.isin(terms, list(query_counts))
+    Q0 = np.zeros(num_terms)
+    Q0[in_query] = [query_counts[term] for term in terms[in_query]]
 
-        # If the document is empty (e.g., non-HTML or no tokens), skip further processing
-        if not tf_map:
-            continue
-
-        # Check user feedback: if the document is marked as relevant
-        if relevance[idx]:
-            num_rel += 1 # Increment count of relevant documents
-            # Accumulate term weights for the relevant documents
-            for term, weight in doc_vector.items():
-                relevant_vec[term] = relevant_vec.get(term, 0.0) + weight
-        else:
-            num_non_rel += 1 # Increment count of non-relevant documents
-            # Accumulate term weights for the non-relevant documents
-            for term, weight in doc_vector.items():
-                non_relevant_vec[term] = non_relevant_vec.get(
-                    term, 0.0) + weight
-
-    # Average the vectors.
-    if num_rel > 0:
-        for term in relevant_vec:
-            relevant_vec[term] /= num_rel
-    if num_non_rel > 0:
-        for term in non_relevant_vec:
-            non_relevant_vec[term] /= num_non_rel
+    # Split the indexed documents (all non-empty) by user feedback.
+    relevant_rows = np.fromiter((relevance[idx] for idx in doc_ids),
+                                dtype=bool, count=len(doc_ids))
+    non_relevant_rows = ~relevant_rows
 
     # Compute the new query vector using Rocchio's formula:
     # Q_new = alpha * Q0 + beta * (average relevant doc vector) - gamma * (average non-relevant doc vector)
-    new_query_vec = {}
-    # Add original query terms.
-    for term, weight in Q0.items():
-        new_query_vec[term] = alpha * weight
-    # Add contribution from relevant docs.
-    for term, weight in relevant_vec.items():
-        new_query_vec[term] = new_query_vec.get(term, 0.0) + beta * weight
-    # Subtract contribution from non-relevant docs.
-    for term, weight in non_relevant_vec.items():
-        new_query_vec[term] = new_query_vec.get(term, 0.0) - gamma * weight
-
-    # Filter out terms already in the current query.
-    current_set = set(t.lower() for t in current_query_terms)
-    candidate_terms = [(term, score) for term,
-                       score in new_query_vec.items() if term not in current_set]
-    candidate_terms.sort(key=lambda x: x[1], reverse=True)
-
-    # Pick up to max_new_terms
-    new_terms = []
-    for term, score in candidate_terms:
-        if score > 0:
-            new_terms.append(term)
-        if len(new_terms) >= max_new_terms:
-            break
+    # Both averages and their combination come from a single sparse matrix-vector
+    # product, by weighting each document row with its share of the formula.
+    num_rel = np.count_nonzero(relevant_rows)
+    num_non_rel = np.count_nonzero(non_relevant_rows)
+    row_weights = np.zeros(len(doc_ids), dtype=np.float32)
+    if num_rel > 0:
+        row_weights[relevant_rows] = beta / num_rel
+    if num_non_rel > 0:
+        row_weights[non_relevant_rows] = -gamma / num_non_rel
+    new_query_vec = alpha * Q0 + tfidf.T @ row_weights
+
+    # Candidates are the terms with a positive score that are not already in the current query.
+    candidates = np.flatnonzero((new_query_vec > 0) & ~in_query)
+
+    # Ties between equal scores go to the term that comes first when reading the
+    # relevant documents, then the non-relevant ones, each in result order
+    # (first_pos is the position of each term in that reading order).
+    reading_order = np.argsort(~relevant_rows, kind="stable")
+    reading_pos = np.empty(len(doc_ids), dtype=np.int64)
+    reading_pos[reading_order] = np.arange(len(doc_ids))
+    entry_rows = np.repeat(np.arange(len(doc_ids)), np.diff(first_rank.indptr))
+    stride = int(first_rank.data.max(initial=0)) + 1
+    first_pos = np.full(num_terms, np.iinfo(np.int64).max)
+    np.minimum.at(first_pos, first_rank.indices,
+                  reading_pos[entry_rows] * stride + first_rank.data)
+
+    # Pick up to max_new_terms: partially sort the candidates to find the
+    # max_new_terms-th best score and keep every candidate scoring at least that much
+    # (so all terms tied at the cut stay), then order just those by score, breaking
+    # ties by first_pos.
+    if len(candidates) > max_new_terms:
+        scores = new_query_vec[candidates]
+        cutoff = -np.partition(-scores, max_new_terms - 1)[max_new_terms - 1]
+        candidates = candidates[scores >= cutoff]
+    order = np.lexsort((first_pos[candidates], -new_query_vec[candidates]))
+    new_terms = [str(terms[col]) for col in candidates[order[:max_new_terms]]]
 
     return new_terms
 
 
 def reorder_query(terms):
     """
-    Use a corpus-based approach with NLTK to rank new terms
+    Use a corpus-based approach with NLTK to rank new terms:
+    return the ordering of the terms whose adjacent pairs are the most frequent
+    bigrams in the Brown corpus.
+    Bigram counts depend on the order of the pair, so orderings (permutations) are
+    scored, which is only done for up to MAX_REORDER_TERMS terms.
     """
-    word1 = terms[0]
-    word2 = terms[1]
-    
-    # Retrieve bigram frequency counts for both possible orders
-    phrase1_freq = bigram_freq[(word1, word2)]
-    phrase2_freq = bigram_freq[(word2, word1)]
+    if len(terms) < 2 or len(terms) > MAX_REORDER_TERMS:
+        return terms
+
+    # Retrieve the bigram frequency of every ordered pair once, all orderings share them
+    bigram_freq = load_bigram_freq()
+    pair_freq = {pair: bigram_freq[pair]
+                 for pair in itertools.permutations(terms, 2)}
 
-    # Return the order that has a higher bigram frequency
-    return terms if phrase1_freq >= phrase2_freq else [word2, word1]
+    # Return the ordering with the highest total bigram frequency
+    # (max keeps the first best one, so ties keep the given order)
+    best_order = max(itertools.permutations(terms),
+                     key=lambda order: sum(pair_freq[pair] for pair in zip(order, order[1:])))
+    return list(best_order)
 
 
 def main():
-    google_api_key, google_engine_id, target_precision, initial_query = parse_args()
+    google_api_key, google_engine_id, target_precision, initial_query, use_full_text = parse_args()
     service = build_service(google_api_key)
 
+    # Relevance given by the user to each URL so far, so repeated results are not asked again
+    seen_relevance = {}
+
+    # Background worker that downloads the result pages while the user gives feedback
+    prefetcher = ThreadPoolExecutor(max_workers=1) if use_full_text else None
+
     # Current query terms
     current_query_terms = initial_query.split()
     iteration = 1
@@ -395,11 +601,20 @@ def main():
             print("No results retrieved. Stopping.")
             break
 
+        # Start fetching the full text of the HTML results in the background,
+        # so it is ready (or nearly) by the time the user has labeled them
+        full_texts_future = None
+        if prefetcher is not None:
+            links = [link for (_, link, _, is_html) in results if is_html]
+            full_texts_future = prefetcher.submit(fetch_full_texts, links)
+
         # Display the results (Optional)
         # display_results(results)
 
         # 2. Get user feedback (y/n)
-        relevance = get_relevance_feedback(results)
+        relevance = get_relevance_feedback(results, seen_relevance)
+        for (_, link, _, _), rel in zip(results, relevance):
+            seen_relevance[link] = rel
 
         # 3. Compute precision (HTML docs only)
         precision = compute_precision(results, relevance)
@@ -414,11 +629,12 @@ def main():
             break
 
         # 5. Compute Raw TF and DF index for these 10 results
-        docs_tokens, df = build_tfidf_index(results, True)
+        full_texts = full_texts_future.result() if full_texts_future else None
+        tfidf, terms, doc_ids, first_rank = build_tfidf_index(results, use_full_text, full_texts)
 
         # 6. Pick up to 2 new terms not already in the query
         new_terms = pick_new_terms_rocchio(
-            current_query_terms, docs_tokens, df, relevance, max_new_terms=2)
+            current_query_terms, tfidf, terms, doc_ids, first_rank, relevance, max_new_terms=2)
         if not new_terms:
             print("No new terms to add. Stopping.")
             break
@@ -432,6 +648,9 @@ def main():
 
         iteration += 1
 
+    if prefetcher is not None:
+        prefetcher.shutdown(wait=False, cancel_futures=True)
+
     print("\n==================== Finished ====================")
     print(f"Final Query: {' '.join(current_query_terms)}")
     print("Goodbye!")